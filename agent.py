@@ -1,31 +1,144 @@
 # agent.py
 import os
+import sys
+import time
 import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from contextvars import ContextVar
 from datetime import datetime, timezone
-from typing import List, Dict, Any
-from weakref import ref
+from functools import lru_cache
+from typing import Awaitable, Callable, List, Dict, Any, Tuple
 
+import grpc
+import httpx
+import numpy as np
 from dotenv import load_dotenv
 load_dotenv()
 
-from openai import OpenAI
-from agents import Agent, Runner, function_tool, set_default_openai_key  # Agents SDK
-from qdrant_client import QdrantClient
+from openai import AsyncOpenAI
+from agents import Agent, Runner, function_tool, set_default_openai_client  # Agents SDK
+from qdrant_client import AsyncQdrantClient, models
 from supabase import create_client, Client
+from postgrest.types import ReturnMethod
+
+# Logy idú na stderr – stdout patrí streamu odpovede pri CLI behu
+_stderr = sys.stderr
 
 # --- Usage accumulators (per-run) ---
-usage_counters = {
-    "embedding_tokens": 0,
-    "embedding_model": "text-embedding-3-small",
-}
+# Každý beh si nastaví vlastný dict; tools bežia v odvodených taskoch/vláknach,
+# ktoré zdieľajú referenciu na ten istý dict, takže súbežné behy sa neprepisujú.
+usage_counters: ContextVar[Dict[str, Any] | None] = ContextVar("usage_counters", default=None)
 
 # --- OpenAI & Qdrant klienti ---
-oi = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
-# Qdrant nastavenia
-qdr = QdrantClient(
-    url=os.environ.get("QDRANT_URL"),
-#    api_key=os.environ.get("QDRANT_API_KEY") or None,
+# Jeden HTTP/2 pool pre všetky OpenAI volania (embeddingy aj LLM cez Agents SDK)
+_http = httpx.AsyncClient(
+    http2=True,
+    timeout=120,
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
 )
+oi = AsyncOpenAI(api_key=os.environ["OPENAI_API_KEY"], http_client=_http)
+set_default_openai_client(oi)
+# Qdrant nastavenia – gRPC posiela vektor ako packed float32 namiesto JSON; predvolene vypnuté (port 6334 býva za firewallom)
+QDRANT_PREFER_GRPC = os.environ.get("QDRANT_PREFER_GRPC", "0") == "1"
+QDRANT_GRPC_PORT = int(os.environ.get("QDRANT_GRPC_PORT", "6334"))
+QDRANT_TIMEOUT = int(os.environ.get("QDRANT_TIMEOUT", "10"))  # s
+
+def _qdrant_client(prefer_grpc: bool) -> AsyncQdrantClient:
+    return AsyncQdrantClient(
+        url=os.environ.get("QDRANT_URL"),
+#        api_key=os.environ.get("QDRANT_API_KEY") or None,
+        prefer_grpc=prefer_grpc,
+        grpc_port=QDRANT_GRPC_PORT,
+    )
+
+qdr = _qdrant_client(QDRANT_PREFER_GRPC)
+_qdr_grpc = QDRANT_PREFER_GRPC
+
+# gRPC chyby, pri ktorých port pravdepodobne nie je dostupný (odmietnuté spojenie / zahadzované pakety)
+_GRPC_FALLBACK_CODES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED)
+
+async def _qdrant_call(fn: Callable[[AsyncQdrantClient], Awaitable[Any]]) -> Any:
+    """
+    Zavolá fn(qdr) s fallbackom: ak gRPC port nie je dostupný (napr. blokovaný infra), prepne klienta na HTTP
+    a volanie zopakuje. Používajú ho všetky volania do Qdrantu.
+    """
+    global qdr, _qdr_grpc
+    client = qdr  # rozhoduje klient, ktorý zlyhal – nie globálny stav po ňom
+    try:
+        return await fn(client)
+    except grpc.RpcError as e:
+        if client is qdr:
+            # Prepína len prvé volanie, ktorému zlyhal aktuálny gRPC klient
+            if not _qdr_grpc or e.code() not in _GRPC_FALLBACK_CODES:
+                raise
+            print(f"[Qdrant] gRPC {e.code().name}, switching to HTTP: {e}", file=_stderr)
+            qdr, _qdr_grpc = _qdrant_client(False), False
+            # Starý gRPC kanál by inak ostal otvorený do konca procesu
+            try:
+                await client.close()
+            except Exception as close_err:
+                print(f"[Qdrant] gRPC client close error: {close_err}", file=_stderr)
+        # Inak už medzitým prepol iný request – starý gRPC klient je vyradený, zopakuj na aktuálnom
+        return await fn(qdr)
+
+async def _qdrant_query_batch(requests: List[models.QueryRequest]):
+    return await _qdrant_call(
+        lambda c: c.query_batch_points(collection_name=COLLECTION, requests=requests, timeout=QDRANT_TIMEOUT)
+    )
+
+# --- Limity súbežnosti, timeouty a circuit breaker pre OpenAI embeddingy a Qdrant ---
+EMBED_CONCURRENCY = int(os.environ.get("EMBED_CONCURRENCY", "8"))
+QDRANT_CONCURRENCY = int(os.environ.get("QDRANT_CONCURRENCY", "8"))
+EMBED_TIMEOUT = float(os.environ.get("EMBED_TIMEOUT", "10"))  # s
+BREAKER_THRESHOLD = 5   # timeoutov za sebou, kým sa okruh otvorí
+BREAKER_COOLDOWN = 30   # s – ako dlho otvorený okruh odmieta volania
+
+class _CircuitBreaker:
+    """
+    Obmedzí súbežné volania semaforom a každé ohraničí timeoutom. Po BREAKER_THRESHOLD timeoutoch za sebou
+    odmieta volania BREAKER_COOLDOWN sekúnd (fail fast); potom pustí jedno skúšobné volanie a ostatné
+    odmieta, kým neuspeje.
+    """
+    def __init__(self, name: str, concurrency: int, timeout: float):
+        self.name = name
+        self.sem = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False  # beží skúšobné volanie po cooldowne (half-open)
+    def _rejects(self) -> bool:
+        return self.failures >= BREAKER_THRESHOLD and (self.probing or time.monotonic() < self.open_until)
+    async def call(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        if self._rejects():
+            raise RuntimeError(f"{self.name} je dočasne nedostupný (circuit open)")
+        async with self.sem:
+            # Kým sme čakali na semafor, okruh sa mohol otvoriť alebo skúšku už prevzalo iné volanie
+            if self._rejects():
+                raise RuntimeError(f"{self.name} je dočasne nedostupný (circuit open)")
+            probe = self.failures >= BREAKER_THRESHOLD
+            if probe:
+                self.probing = True
+            try:
+                result = await asyncio.wait_for(fn(), self.timeout)
+            except asyncio.TimeoutError:
+                self.failures += 1
+                if self.failures >= BREAKER_THRESHOLD:
+                    self.open_until = time.monotonic() + BREAKER_COOLDOWN
+                    print(f"[{self.name}] {self.failures} timeouts in a row, circuit open for {BREAKER_COOLDOWN}s", file=_stderr)
+                raise
+            finally:
+                # Aj neúspešná skúška uvoľní miesto – ďalšia príde po cooldowne (timeout) alebo hneď (iná chyba)
+                if probe:
+                    self.probing = False
+        self.failures = 0
+        return result
+
+_embed_breaker = _CircuitBreaker("Embeddings", EMBED_CONCURRENCY, EMBED_TIMEOUT)
+# Pri gRPC musí timeout pokryť aj DEADLINE_EXCEEDED + opakovanie cez HTTP
+_qdrant_breaker = _CircuitBreaker("Qdrant", QDRANT_CONCURRENCY, QDRANT_TIMEOUT * (2 if QDRANT_PREFER_GRPC else 1))
 
 # Supabase klient
 SUPABASE_URL = os.environ["SUPABASE_URL"]
@@ -34,82 +147,604 @@ sb: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 COLLECTION = os.environ.get("QDRANT_COLLECTION", "esmeralda")
 
-# --- Pomocná embedding funkcia ---
-def embed(text: str) -> List[float]:
-    r = oi.embeddings.create(model="text-embedding-3-small", input=text)
+# --- Cache embeddingov: LRU v pamäti + voliteľne SQLite na disku ---
+EMBED_MODEL = "text-embedding-3-small"
+EMBED_CACHE_SIZE = int(os.environ.get("EMBED_CACHE_SIZE", "4096"))
+EMBED_CACHE_TTL = float(os.environ.get("EMBED_CACHE_TTL", "3600"))  # s, pre LRU v pamäti; 0 = bez TTL
+EMBED_CACHE_DB = os.environ.get("EMBED_CACHE_DB")  # cesta k SQLite súboru; nenastavené = len pamäť
+EMBED_CACHE_DB_MAX_MB = int(os.environ.get("EMBED_CACHE_DB_MAX_MB", "512"))  # strop pre vektory na disku; 0 = bez stropu
+EMBED_CACHE_PRUNE_EVERY = 256  # kontrola veľkosti po každých N zápisoch
+EMBED_WARMUP_FILE = os.environ.get("EMBED_WARMUP_FILE")  # frázy na predhriatie cache, jedna na riadok
+EMBED_WARMUP_SESSION = os.environ.get("EMBED_WARMUP_SESSION", "embed-warmup")  # session_id pre usage predhriatia
+# Cache drží vektory vo float16 (polovičná pamäť aj disk); von ide vždy float32
+EMBED_CACHE_DTYPE = np.float16
+EMBED_CACHE_TABLE = "embed_cache_f16"  # nová tabuľka; stará float32 tabuľka embed_cache sa pri otvorení zmaže
+
+_embed_lru: "OrderedDict[bytes, Tuple[np.ndarray, float]]" = OrderedDict()  # key -> (float16 vektor, čas vloženia)
+_embed_lock = threading.Lock()     # LRU v pamäti – krátke operácie, aj z event loopu
+_embed_db: sqlite3.Connection | None = None
+_embed_db_lock = threading.Lock()  # SQLite – len z worker vlákien (busy_timeout môže blokovať sekundy)
+_embed_db_writes = 0
+_embed_db_closed = False  # po close_clients sa SQLite už znova neotvára
+_embed_db_pending: "set[asyncio.Future]" = set()  # zápisy na disk bežiace v executore
+
+def _embed_key(model: str, text: str) -> bytes:
+    # Normalizácia: veľkosť písmen a biele znaky nemenia význam frázy
+    normalized = " ".join(text.split()).casefold()
+    return hashlib.sha256(f"{model}\0{normalized}".encode("utf-8")).digest()
+
+def _embed_db_conn() -> sqlite3.Connection | None:
+    """Lenivo otvorí SQLite cache (raz za proces). Volať pod _embed_db_lock."""
+    global _embed_db
+    if _embed_db is None and EMBED_CACHE_DB and not _embed_db_closed:
+        try:
+            conn = sqlite3.connect(EMBED_CACHE_DB, check_same_thread=False)
+            # Jedno spojenie na proces; WAL dovolí súbežné čítanie z ďalších workerov
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {EMBED_CACHE_TABLE} (key BLOB PRIMARY KEY, vec BLOB NOT NULL)")
+            # Stará float32 cache sa už nečíta ani neorezáva – inak by súbor rástol mimo EMBED_CACHE_DB_MAX_MB
+            conn.execute("DROP TABLE IF EXISTS embed_cache")
+            conn.commit()
+            _embed_db = conn
+        except Exception as e:
+            print(f"[EmbedCache] SQLite open error: {e}", file=_stderr)
+    return _embed_db
+
+def _embed_lru_get(key: bytes) -> np.ndarray | None:
+    with _embed_lock:
+        entry = _embed_lru.get(key)
+        if entry is None:
+            return None
+        if EMBED_CACHE_TTL <= 0 or time.monotonic() - entry[1] < EMBED_CACHE_TTL:
+            _embed_lru.move_to_end(key)
+            return entry[0].astype(np.float32)
+        del _embed_lru[key]
+        return None
+
+def _embed_lru_put(key: bytes, vec: np.ndarray) -> None:
+    with _embed_lock:
+        _embed_lru[key] = (vec.astype(EMBED_CACHE_DTYPE), time.monotonic())
+        _embed_lru.move_to_end(key)
+        while len(_embed_lru) > EMBED_CACHE_SIZE:
+            _embed_lru.popitem(last=False)
+
+def _embed_db_get_many(keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+    """Načíta vektory (float16) zo SQLite. Blokujúce – volať cez asyncio.to_thread."""
+    found: Dict[bytes, np.ndarray] = {}
+    with _embed_db_lock:
+        conn = _embed_db_conn()
+        if conn is None:
+            return found
+        try:
+            for key in keys:
+                row = conn.execute(f"SELECT vec FROM {EMBED_CACHE_TABLE} WHERE key = ?", (key,)).fetchone()
+                if row:
+                    found[key] = np.frombuffer(row[0], dtype=EMBED_CACHE_DTYPE)
+        except Exception as e:
+            print(f"[EmbedCache] SQLite read error: {e}", file=_stderr)
+    return found
+
+def _embed_db_put_many(items: List[Tuple[bytes, np.ndarray]]) -> None:
+    """Zapíše vektory do SQLite (jeden commit) a občas oreže cache. Blokujúce – púšťa sa vo vlákne na pozadí."""
+    global _embed_db_writes
+    with _embed_db_lock:
+        conn = _embed_db_conn()
+        if conn is None:
+            return
+        try:
+            conn.executemany(
+                f"INSERT OR IGNORE INTO {EMBED_CACHE_TABLE} (key, vec) VALUES (?, ?)",
+                [(key, vec.astype(EMBED_CACHE_DTYPE).tobytes()) for key, vec in items],
+            )
+            conn.commit()
+        except Exception as e:
+            print(f"[EmbedCache] SQLite write error: {e}", file=_stderr)
+            return
+        before = _embed_db_writes
+        _embed_db_writes += len(items)
+        if EMBED_CACHE_DB_MAX_MB > 0 and before // EMBED_CACHE_PRUNE_EVERY != _embed_db_writes // EMBED_CACHE_PRUNE_EVERY:
+            row_bytes = max(items[0][1].size * np.dtype(EMBED_CACHE_DTYPE).itemsize, 1)
+            _embed_db_prune(conn, max(1, (EMBED_CACHE_DB_MAX_MB << 20) // row_bytes))
+
+def _embed_db_prune(conn: sqlite3.Connection, max_rows: int) -> None:
+    """Zmaže najstaršie riadky (podľa rowid = poradie vloženia) nad strop. Volať pod _embed_db_lock."""
+    try:
+        count = conn.execute(f"SELECT COUNT(*) FROM {EMBED_CACHE_TABLE}").fetchone()[0]
+        if count > max_rows:
+            conn.execute(
+                f"DELETE FROM {EMBED_CACHE_TABLE} WHERE rowid IN "
+                f"(SELECT rowid FROM {EMBED_CACHE_TABLE} ORDER BY rowid LIMIT ?)",
+                (count - max_rows,),
+            )
+            conn.commit()
+    except Exception as e:
+        print(f"[EmbedCache] SQLite prune error: {e}", file=_stderr)
+
+# --- Pomocné embedding funkcie ---
+def _record_embedding_usage(r) -> None:
+    counters = usage_counters.get()
+    if counters is None:
+        return
     # Record embedding token usage if available
     try:
         # Some SDK versions expose r.usage.prompt_tokens
-        prompt_tokens = 0
-        if hasattr(r, "usage") and getattr(r.usage, "prompt_tokens", None) is not None:
-            prompt_tokens = int(r.usage.prompt_tokens)
-        usage_counters["embedding_tokens"] += prompt_tokens
+        counters["embedding_tokens"] += int(r.usage.prompt_tokens or 0)
     except Exception:
         # Be permissive; usage may be missing in some responses
         pass
     # Prefer explicit model name we requested; fall back to response field if present
     try:
-        usage_counters["embedding_model"] = getattr(r, "model", None) or "text-embedding-3-small"
+        counters["embedding_model"] = getattr(r, "model", None) or EMBED_MODEL
     except Exception:
-        usage_counters["embedding_model"] = "text-embedding-3-small"
-    return r.data[0].embedding
+        counters["embedding_model"] = EMBED_MODEL
 
-# --- Tool: vyhľadávanie v Qdrante s PRESNÝM filtrom (vrátane null polí) ---
-@function_tool
-def search_law(query: str) -> List[Dict[str, Any]]:
+async def embed_batch(texts: List[str]) -> List[np.ndarray]:
     """
-    Vyhľadá relevantné právne dokumenty v Qdrant kolekcii 'esmeralda' podľa textového dopytu.
-    Návratová hodnota: pole {id, score, payload}.
+    Embeddingy (float32 ndarray) pre viac textov naraz. Zásahy idú z cache, chýbajúce sa pošlú jedným API volaním.
+    Poradie výstupu zodpovedá poradiu `texts`.
     """
-    vector = embed(query)
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    keys = [_embed_key(EMBED_MODEL, t) for t in texts]
+    vectors: List[np.ndarray | None] = [None] * len(texts)
+    # Chýbajúce kľúče bez duplicít: key -> indexy v `texts` (model často pošle tú istú frázu viackrát)
+    pending: Dict[bytes, List[int]] = {}
+    for i, key in enumerate(keys):
+        if key in pending:
+            pending[key].append(i)
+            continue
+        vectors[i] = _embed_lru_get(key)
+        if vectors[i] is None:
+            pending[key] = [i]
+    if pending and EMBED_CACHE_DB:
+        # SQLite mimo event loopu – pri zamknutom WAL by inak stáli všetky streamy v procese
+        for key, vec16 in (await asyncio.to_thread(_embed_db_get_many, list(pending))).items():
+            _embed_lru_put(key, vec16)
+            vec = vec16.astype(np.float32)
+            for i in pending.pop(key):
+                vectors[i] = vec
+    if pending:
+        misses = list(pending.values())
+        r = await _embed_breaker.call(
+            lambda: oi.embeddings.create(model=EMBED_MODEL, input=[texts[idx[0]] for idx in misses])
+        )
+        # Cache hity sa neúčtujú – usage je len za skutočné API volanie
+        _record_embedding_usage(r)
+        fresh: List[Tuple[bytes, np.ndarray]] = []
+        for d in r.data:
+            idx = misses[d.index]
+            # Rovnako zaokrúhlené ako pri zásahu cache – vektor frázy nezávisí od stavu cache
+            vec = np.asarray(d.embedding, dtype=np.float32).astype(EMBED_CACHE_DTYPE).astype(np.float32)
+            for i in idx:
+                vectors[i] = vec
+            _embed_lru_put(keys[idx[0]], vec)
+            fresh.append((keys[idx[0]], vec))
+        if EMBED_CACHE_DB and fresh:
+            # Zápis na disk request nečaká – beží vo vlákne na pozadí; close_clients ho dobehne
+            fut = asyncio.get_running_loop().run_in_executor(None, _embed_db_put_many, fresh)
+            _embed_db_pending.add(fut)
+            fut.add_done_callback(_embed_db_pending.discard)
+    return vectors
+
+async def embed(text: str) -> np.ndarray:
+    return (await embed_batch([text]))[0]
 
-    # Filter presne podľa tvojej špecifikácie (vrátane null hodnôt)
-    q_filter = {
-        "should": [
-            {"is_null": {"key": "metadata.validTo"}},
-            {"key": "metadata.validTo", "range": {"gt": None, "gte": today, "lt": None, "lte": None}},
+async def warm_embed_cache(path: str | None = EMBED_WARMUP_FILE, batch_size: int = 256) -> int:
+    """
+    Predhreje zdieľanú SQLite cache embeddingov častými frázami zo súboru (jedna na riadok). Vráti počet fráz.
+    Admin krok, raz za nasadenie: `python agent.py --warm-embed-cache`. Bez EMBED_CACHE_DB nemá zmysel
+    (cache jedného procesu by zanikla s ním). Už uložené frázy API nevolajú; zaplatené tokeny sa zapíšu
+    do tokenUsage pod session EMBED_WARMUP_SESSION.
+    """
+    if not path:
+        return 0
+    if not EMBED_CACHE_DB:
+        print("[EmbedCache] Warm-up skipped: EMBED_CACHE_DB is not set", file=_stderr)
+        return 0
+    try:
+        with open(path, encoding="utf-8") as f:
+            phrases = [line.strip() for line in f if line.strip()]
+    except OSError as e:
+        print(f"[EmbedCache] Warm-up file error: {e}", file=_stderr)
+        return 0
+    counters = {"embedding_tokens": 0, "embedding_model": EMBED_MODEL}
+    counters_token = usage_counters.set(counters)
+    try:
+        for i in range(0, len(phrases), batch_size):
+            try:
+                await embed_batch(phrases[i:i + batch_size])
+            except Exception as e:
+                print(f"[EmbedCache] Warm-up error: {e}", file=_stderr)
+                break
+    finally:
+        usage_counters.reset(counters_token)
+        if counters["embedding_tokens"]:
+            save_token_usage(
+                EMBED_WARMUP_SESSION,
+                counters["embedding_model"],
+                0,
+                0,
+                embedding_model=counters["embedding_model"],
+                embedding_input_tokens=counters["embedding_tokens"],
+            )
+    return len(phrases)
+
+# --- Sémantická cache výsledkov search_law/search_laws (takmer zhodné dopyty) ---
+SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE", "512"))
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.97"))
+# Po tomto čase (s) sa výsledok znova pýta z Qdrantu – zachytí nové/upravené body v kolekcii
+SEMANTIC_CACHE_TTL = float(os.environ.get("SEMANTIC_CACHE_TTL", "600"))
+
+class _SemanticCache:
+    """
+    Kruhový buffer posledných N normalizovaných vektorov dopytov a ich výsledkov.
+    Lookup je jedno násobenie matice vektorom (kosínusová podobnosť).
+    Záznamy platia `ttl` sekúnd a len pre rovnaký `scope` (stav filtra + deň); zmena scope cache vyprázdni.
+    """
+    def __init__(self, size: int, threshold: float, ttl: float):
+        self.size = size
+        self.threshold = threshold
+        self.ttl = ttl
+        self.vectors: np.ndarray | None = None  # (size, dim) float32, riadky L2-normalizované
+        self.stamps = np.zeros(size, dtype=np.float64)  # čas vloženia (monotonic) pre každý slot
+        self.results: List[Any] = [None] * size
+        self.count = 0
+        self.next = 0
+        self.scope: Any = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(v))
+        return v / norm if norm else v
+
+    def _check_scope(self, scope: Any) -> None:
+        # Volať pod self.lock
+        if scope != self.scope:
+            self.scope = scope
+            self.count = self.next = 0
+            self.results = [None] * self.size
+
+    def get(self, vector, scope: Any = None) -> Any:
+        if self.size <= 0 or self.count == 0:
+            return None
+        q = self._normalize(vector)
+        with self.lock:
+            self._check_scope(scope)
+            if self.count == 0 or self.vectors is None or self.vectors.shape[1] != q.shape[0]:
+                return None
+            sims = self.vectors[:self.count] @ q
+            if self.ttl > 0:
+                # Expirované sloty sa nesmú trafiť
+                sims[self.stamps[:self.count] < time.monotonic() - self.ttl] = -np.inf
+            i = int(np.argmax(sims))
+            if sims[i] >= self.threshold:
+                return self.results[i]
+        return None
+
+    def put(self, vector, result: Any, scope: Any = None) -> None:
+        if self.size <= 0:
+            return
+        q = self._normalize(vector)
+        with self.lock:
+            self._check_scope(scope)
+            if self.vectors is None or self.vectors.shape[1] != q.shape[0]:
+                self.vectors = np.zeros((self.size, q.shape[0]), dtype=np.float32)
+                self.count = self.next = 0
+            self.vectors[self.next] = q
+            self.stamps[self.next] = time.monotonic()
+            self.results[self.next] = result
+            self.next = (self.next + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+
+_search_cache = _SemanticCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL)
+
+# --- Vyhľadávanie v Qdrante s PRESNÝM filtrom (vrátane null polí) ---
+# Filter platnosti (metadata.validTo) je zatiaľ vypnutý; zapína sa cez QDRANT_VALIDITY_FILTER=1
+USE_VALIDITY_FILTER = os.environ.get("QDRANT_VALIDITY_FILTER", "0") == "1"
+VALIDITY_FIELD = "metadata.validTo"
+
+# --- Parametre HNSW a kvantizácie ---
+SEARCH_LIMIT = 5
+QDRANT_HNSW_EF = int(os.environ.get("QDRANT_HNSW_EF", "0"))  # 0 = max(64, 8 * limit)
+QDRANT_QUANTIZE = os.environ.get("QDRANT_QUANTIZE", "0") == "1"  # int8 scalar kvantizácia kolekcie (pri --provision)
+QDRANT_OVERSAMPLING = float(os.environ.get("QDRANT_OVERSAMPLING", "2.0"))
+
+_SEARCH_PARAMS = models.SearchParams(
+    hnsw_ef=QDRANT_HNSW_EF or max(64, 8 * SEARCH_LIMIT),
+    # Bez kvantizovanej kolekcie Qdrant tieto parametre ignoruje
+    quantization=models.QuantizationSearchParams(ignore=False, rescore=True, oversampling=QDRANT_OVERSAMPLING),
+)
+
+async def provision_collection() -> None:
+    """
+    Jednorazové nastavenie kolekcie (admin krok, nie request path): `python agent.py --provision`.
+    - datetime payload index na metadata.validTo (bez neho Qdrant filtruje platnosť bod po bode),
+    - s QDRANT_QUANTIZE=1 int8 scalar kvantizácia (vektory v RAM, originály na rescore).
+    Obe operácie sú idempotentné. Stav overíš cez GET /collections/{name}.
+    """
+    try:
+        await _qdrant_call(lambda c: c.create_payload_index(
+            collection_name=COLLECTION,
+            field_name=VALIDITY_FIELD,
+            field_schema=models.PayloadSchemaType.DATETIME,
+            wait=True,
+        ))
+        print(f"[Qdrant] payload index on {VALIDITY_FIELD} ready", file=_stderr)
+    except Exception as e:
+        print(f"[Qdrant] create_payload_index error: {e}", file=_stderr)
+    if not QDRANT_QUANTIZE:
+        return
+    try:
+        await _qdrant_call(lambda c: c.update_collection(
+            collection_name=COLLECTION,
+            quantization_config=models.ScalarQuantization(
+                scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True),
+            ),
+        ))
+        print("[Qdrant] int8 scalar quantization enabled", file=_stderr)
+    except Exception as e:
+        print(f"[Qdrant] update_collection (quantization) error: {e}", file=_stderr)
+
+_today_cache: Tuple[int, str] = (-1, "")
+
+def _today() -> str:
+    """Dnešný UTC dátum (YYYY-MM-DD); formátuje sa len raz za deň."""
+    global _today_cache
+    day = int(time.time() // 86400)
+    if day != _today_cache[0]:
+        _today_cache = (day, time.strftime("%Y-%m-%d", time.gmtime(day * 86400)))
+    return _today_cache[1]
+
+@lru_cache(maxsize=2)
+def _validity_filter(today: str) -> models.Filter:
+    # Vylúči len predpisy, ktorých platnosť skončila pred dneškom; validTo = null aj CHÝBAJÚCE validTo prejde.
+    # Zmena správania oproti pôvodnému should[is_null, gte today]: is_null v Qdrante nezachytí chýbajúci kľúč,
+    # takže body bez validTo boli predtým vylúčené a teraz sa vracajú (bez dátumu konca platnosti = platné).
+    # Typovaný Filter (nie dict) sa nevaliduje pri každom QueryRequest; cache drží jeden na deň.
+    return models.Filter(
+        must_not=[
+            models.FieldCondition(key=VALIDITY_FIELD, range=models.DatetimeRange(lt=today)),
         ]
-    }
-
-    body = dict(
-        vector=vector,
-        limit=10,
-        with_payload=True,
-        with_vectors=False,
-        query_filter=q_filter,  # qdrant-client akceptuje aj dict (prejde ako raw JSON)
     )
 
-    # qdrant-client: search(collection_name=..., query_vector=..., ...)
-    res = qdr.query_points(
-        collection_name=COLLECTION,
-        query=vector,
-        limit=5,
-        with_payload=True,
-        with_vectors=False,
-#        query_filter=q_filter,
-        timeout=120,
-    )
-    return [
-        {"id": p.id, "score": p.score, "payload": p.payload}
-        for p in res.points
+async def _search_vectors(vectors: List[np.ndarray]) -> List[List[Dict[str, Any]]]:
+    """
+    Vráti top výsledky z Qdrant kolekcie pre hotové vektory dopytov: pre každý pole {id, score, payload}.
+    Vektory mimo sémantickej cache idú do Qdrantu jedným batch requestom.
+    """
+    # Výsledky závisia od filtra platnosti a dňa – cache z iného scope sa nepoužije
+    scope = (USE_VALIDITY_FILTER, _today())
+    results: List[List[Dict[str, Any]] | None] = [_search_cache.get(v, scope) for v in vectors]
+    misses = [i for i, r in enumerate(results) if r is None]
+    if not misses:
+        return results
+    q_filter = _validity_filter(_today()) if USE_VALIDITY_FILTER else None
+
+    # qdrant-client: query_batch_points – N vektorových dopytov v jednom HTTP volaní
+    requests = [
+        models.QueryRequest(
+            query=vectors[i].tolist(),  # QueryRequest validuje List[float]
+            limit=SEARCH_LIMIT,
+            with_payload=True,
+            with_vector=False,
+            filter=q_filter,
+            params=_SEARCH_PARAMS,
+        )
+        for i in misses
     ]
-    print(">>> ID:", p.id, "SCORE:", p.score, "PAYLOAD:", p.payload)
+    responses = await _qdrant_breaker.call(lambda: _qdrant_query_batch(requests))
+    for i, res in zip(misses, responses):
+        found = [
+            {"id": p.id, "score": p.score, "payload": p.payload}
+            for p in res.points
+        ]
+        _search_cache.put(vectors[i], found, scope)
+        results[i] = found
+    return results
+
+async def _search_many(queries: List[str]) -> List[List[Dict[str, Any]]]:
+    """
+    Spoločná cesta pre oba tools: jeden embedding request a jeden batch dopyt do Qdrantu pre všetky frázy.
+    """
+    if not queries:
+        return []
+    vectors = await embed_batch(queries)
+    return await _search_vectors(vectors)
+
+# --- Tools pre agenta ---
+@function_tool
+async def search_law(query: str) -> List[Dict[str, Any]]:
+    """
+    Vyhľadá relevantné právne dokumenty v Qdrant kolekcii 'esmeralda' podľa textového dopytu.
+    Návratová hodnota: pole {id, score, payload}.
+    """
+    return (await _search_many([query]))[0]
+
+@function_tool
+async def search_laws(queries: List[str]) -> List[Dict[str, Any]]:
+    """
+    Vyhľadá relevantné právne dokumenty pre viac fráz naraz (jeden embedding request, jeden batch dopyt do Qdrantu).
+    Návratová hodnota: pole {id, score, payload} bez duplicít (najlepšie skóre naprieč frázami), zoradené podľa skóre.
+    """
+    merged: Dict[Any, Dict[str, Any]] = {}
+    for hits in await _search_many(queries):
+        for hit in hits:
+            best = merged.get(hit["id"])
+            if best is None or hit["score"] > best["score"]:
+                merged[hit["id"]] = hit
+    return sorted(merged.values(), key=lambda h: h["score"], reverse=True)
+
+# --- Pamäť konverzácie v procese (voliteľná; write-through, Supabase len pre studené session) ---
+MEMORY_LIMIT = 10
+# Len pre nasadenie s jedným workerom: pri viacerých workeroch bez session affinity by teplá cache
+# jedného workera nevidela ťahy obslúžené iným workerom. Predvolene vypnuté – pamäť ide vždy zo Supabase.
+MEMORY_CACHE = os.environ.get("MEMORY_CACHE", "0") == "1"
+MEMORY_CACHE_SESSIONS = int(os.environ.get("MEMORY_CACHE_SESSIONS", "1024"))
+# Po tomto čase (s) sa session znova načíta zo Supabase – len poistka proti zápisom mimo tohto procesu
+# (napr. CLI, ručné úpravy); konzistenciu medzi workermi NERIEŠI, preto MEMORY_CACHE len pri jednom workerovi
+MEMORY_CACHE_TTL = float(os.environ.get("MEMORY_CACHE_TTL", "60"))
+
+_ROLE_PREFIX = {"user": "user: ", "assistant": "assistant: ", "system": "system: "}
+
+def _memory_row(role: str, content: str) -> Dict[str, Any]:
+    """Riadok pamäte s predformátovaným `line` ("role: content") – blok pamäte je potom len join."""
+    return {"role": role, "content": content, "line": (_ROLE_PREFIX.get(role) or role + ": ") + content}
+
+_memory: "OrderedDict[str, Tuple[float, deque]]" = OrderedDict()  # session_id -> (čas načítania, správy)
+_memory_lock = threading.Lock()
+
+def _memory_get(session_id: str) -> List[Dict[str, Any]] | None:
+    if not MEMORY_CACHE:
+        return None
+    with _memory_lock:
+        entry = _memory.get(session_id)
+        if entry is None:
+            return None
+        if MEMORY_CACHE_TTL > 0 and time.monotonic() - entry[0] >= MEMORY_CACHE_TTL:
+            del _memory[session_id]
+            return None
+        _memory.move_to_end(session_id)
+        return list(entry[1])
+
+def _memory_load(session_id: str, rows: List[Dict[str, Any]]) -> None:
+    if not MEMORY_CACHE:
+        return
+    with _memory_lock:
+        _memory[session_id] = (time.monotonic(), deque(
+            (_memory_row(r["role"], r["content"]) for r in rows), maxlen=MEMORY_LIMIT
+        ))
+        _memory.move_to_end(session_id)
+        while len(_memory) > MEMORY_CACHE_SESSIONS:
+            _memory.popitem(last=False)
+
+def _memory_append(session_id: str, role: str, content: str) -> None:
+    # Len pre teplé session – studená sa pri najbližšom fetch_memory načíta celá zo Supabase
+    if not MEMORY_CACHE:
+        return
+    with _memory_lock:
+        entry = _memory.get(session_id)
+        if entry is not None:
+            entry[1].append(_memory_row(role, content))
+
+# --- Zápis do Supabase: fronta + dávkový writer na pozadí ---
+WRITE_BATCH_SIZE = 200        # max riadkov v jednej dávke
+WRITE_FLUSH_INTERVAL = 0.05   # s – ako dlho dávka čaká na ďalšie riadky
+POSTGREST_MAX_ROWS = 500      # väčšie inserty delíme (limity payloadu PostgREST)
+
+_FLUSH = None  # značka vo fronte: zapíš hneď, nečakaj na okno
+
+_write_queue: asyncio.Queue | None = None
+_writer_task: asyncio.Task | None = None
+
+def _insert_rows(table: str, rows: List[Dict[str, Any]]) -> None:
+    for i in range(0, len(rows), POSTGREST_MAX_ROWS):
+        chunk = rows[i:i + POSTGREST_MAX_ROWS]
+        try:
+            # return=minimal: PostgREST nevracia vložené riadky (menšia odpoveď, žiadne parsovanie)
+            sb.table(table).insert(chunk, returning=ReturnMethod.minimal).execute()
+        except Exception as e:
+            # Nezastavuj beh agenta kvôli logovaniu
+            print(f"[Supabase] Insert error ({table}, {len(chunk)} rows): {e}", file=_stderr)
+
+async def _writer(q: asyncio.Queue) -> None:
+    """
+    Zbiera riadky z fronty počas WRITE_FLUSH_INTERVAL (max WRITE_BATCH_SIZE, alebo po značke _FLUSH)
+    a zapíše ich jedným insertom na tabuľku.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await q.get()]
+        deadline = loop.time() + WRITE_FLUSH_INTERVAL
+        while batch[-1] is not _FLUSH and len(batch) < WRITE_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(q.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        by_table: Dict[str, List[Dict[str, Any]]] = {}
+        for item in batch:
+            if item is not _FLUSH:
+                by_table.setdefault(item[0], []).append(item[1])
+        try:
+            for table, rows in by_table.items():
+                await asyncio.to_thread(_insert_rows, table, rows)
+        finally:
+            for _ in batch:
+                q.task_done()
+
+def start_writer() -> asyncio.Queue:
+    """
+    Spustí writer v aktuálnom event loope (ak ešte nebeží). app.py ho volá pri štarte servera,
+    run_once/save_* ho inak spustia lenivo pri prvom zápise.
+    """
+    global _write_queue, _writer_task
+    loop = asyncio.get_running_loop()
+    if _writer_task is None or _writer_task.done() or _writer_task.get_loop() is not loop:
+        _write_queue = asyncio.Queue()
+        _writer_task = loop.create_task(_writer(_write_queue))
+    return _write_queue
+
+def _enqueue_row(table: str, row: Dict[str, Any]) -> None:
+    """
+    Zaradí riadok do fronty writera v aktuálnom event loope. Mimo loopu zapíše priamo.
+    """
+    try:
+        q = start_writer()
+    except RuntimeError:
+        _insert_rows(table, [row])
+        return
+    q.put_nowait((table, row))
+
+async def flush_writes() -> None:
+    """
+    Vynúti zápis rozpracovanej dávky a počká, kým writer zapíše VŠETKY zaradené riadky (všetkých session).
+    Globálny drain – len pre koniec CLI behu a vypnutie servera (close_clients); v requeste ho nevolať,
+    pri stálej prevádzke by čakal aj na riadky cudzích ťahov.
+    """
+    if _write_queue is not None and _writer_task is not None and not _writer_task.done():
+        _write_queue.put_nowait(_FLUSH)
+        await _write_queue.join()
+
+async def close_clients() -> None:
+    """
+    Zapíše frontu a zavrie zdieľané klienty (HTTP/2 pool OpenAI, Qdrant, SQLite cache). Volá app.py pri vypnutí.
+    """
+    global _embed_db, _embed_db_closed
+    await flush_writes()
+    if _writer_task is not None:
+        _writer_task.cancel()
+    for close in (qdr.close, _http.aclose):
+        try:
+            await close()
+        except Exception as e:
+            print(f"[Shutdown] Client close error: {e}", file=_stderr)
+    # Rozbehnuté zápisy do SQLite dobehnú pred zatvorením – inak by si spojenie znova otvorili
+    for res in await asyncio.gather(*_embed_db_pending, return_exceptions=True):
+        if isinstance(res, Exception):
+            print(f"[EmbedCache] SQLite write error: {res}", file=_stderr)
+    with _embed_db_lock:
+        _embed_db_closed = True
+        if _embed_db is not None:
+            _embed_db.close()
+            _embed_db = None
 
 def save_message(session_id: str, role: str, content: str) -> None:
     """
-    Uloží správu do public.chatMessages v Supabase.
+    Zaradí správu na zápis do public.chatMessages v Supabase (neblokuje) a pridá ju do pamäte session.
     Očakáva role ∈ {"user","assistant"}.
     """
-    try:
-        sb.table("chatMessages").insert({
-            "session_id": session_id,
-            "role": role,
-            "content": content
-        }).execute()
-    except Exception as e:
-        # Nezastavuj beh agenta kvôli logovaniu
-        print(f"[Supabase] Insert error: {e}")
+    _memory_append(session_id, role, content)
+    _enqueue_row("chatMessages", {
+        "session_id": session_id,
+        "role": role,
+        "content": content,
+        # čas nastavíme pri zaradení – v jednej dávke by mali všetky riadky rovnaký now()
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    })
 
 def save_token_usage(
     session_id: str,
@@ -121,139 +756,267 @@ def save_token_usage(
     embedding_input_tokens: int = 0,
 ) -> None:
     """
-    Uloží token usage do public.tokenUsage v Supabase vrátane embeddingov.
+    Zaradí token usage na zápis do public.tokenUsage v Supabase vrátane embeddingov (neblokuje).
     """
-    try:
-        sb.table("tokenUsage").insert({
-            "session_id": session_id,
-            "model": model,
-            "input_tokens": input_tokens,
-            "output_tokens": output_tokens,
-            "embedding_model": embedding_model,
-            "embedding_input_tokens": int(embedding_input_tokens or 0),
-        }).execute()
-    except Exception as e:
-        print(f"[Supabase] Token usage insert error: {e}")
+    _enqueue_row("tokenUsage", {
+        "session_id": session_id,
+        "model": model,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "embedding_model": embedding_model,
+        "embedding_input_tokens": int(embedding_input_tokens or 0),
+    })
 
-def fetch_memory(session_id: str, limit: int = 10) -> List[Dict[str, Any]]:
+def fetch_memory(session_id: str, limit: int = MEMORY_LIMIT) -> List[Dict[str, Any]]:
     """
     Načíta posledných `limit` správ zo session a vráti ich v chronologickom poradí (najstaršia -> najnovšia).
+    S MEMORY_CACHE=1 sa teplá session obslúži z pamäte procesu; inak (predvolene) sa vždy pýta Supabase.
+    Dopyt (eq session_id + order created_at desc + limit) pokrýva index:
+        CREATE INDEX IF NOT EXISTS idx_chatmsg_sess_ts ON public."chatMessages" (session_id, created_at DESC);
     """
+    if limit <= MEMORY_LIMIT:
+        rows = _memory_get(session_id)
+        if rows is not None:
+            return rows[-limit:] if limit else []
     try:
         resp = sb.table("chatMessages")\
-            .select("role,content,created_at")\
+            .select("role,content")\
             .eq("session_id", session_id)\
             .order("created_at", desc=True)\
-            .limit(limit)\
+            .limit(max(limit, MEMORY_LIMIT))\
             .execute()
-        rows = (getattr(resp, "data", None) or [])
+        try:
+            rows = resp.data or []
+        except AttributeError:
+            rows = []
         # otoč na chronologické poradie
         rows.reverse()
-        return rows
+        _memory_load(session_id, rows)
+        return rows[-limit:] if limit else []
     except Exception as e:
-        print(f"[Supabase] Fetch memory error: {e}")
+        print(f"[Supabase] Fetch memory error: {e}", file=_stderr)
         return []
 
+# --- Inštrukcie agenta (konštantné – rovnaký prefix promptu pre všetky requesty, bez per-user kópií) ---
+# Meno používateľa do inštrukcií nepatrí; ak ho má model poznať, ide do vstupu ([USER QUESTION] blok)
+INSTRUCTIONS = (
+    "Si právna asistentka pre SR. Na vyhľdávanie v právnych textoch môžeš použiť nástroje search_laws a search_law."
+    "Odpovedaj v konverzčnom štýle, nedávaj rady, iba odporúčania ak treba. Nepoužívaj odrážky ani číslovanie."
+    "Ak uvádzaš referenciu na použitý text, použi payload z qdrantu metadata.regulation."
+    "Otázku používateľa rozlož semanticky na menšie frázy (2–7 slov) a pošli ich naraz ako zoznam do search_laws; search_law použi len pre jednu frázu."
+)
+
 # --- Agent: používa len tool výstupy ---
+# Jeden zdieľaný agent; počas behu sa nemení, takže je bezpečný pri súbežných requestoch
 esmeralda = Agent(
     name="Esmeralda",
     model="gpt-5-mini",
-    instructions=(
-        "Si právna asistentka pre SR. Na vyhľdávanie v právnych textoch môžeš použiť nástroj searchLaw."
-        "Odpovedaj v konverzčnom štýle, nedávaj rady, iba odporúčania ak treba. Nepoužívaj odrážky ani číslovanie."
-        "Ak uvádzaš referenciu na použitý text, použi payload z qdrantu metadata.regulation."
-        "Otázku používateľa rozlož semanticky na menšie frázy (2–7 slov), ktoré jednotlivo posielaj do searchLaw."
-    ).format(name="{name}"),
-
-    tools=[search_law],
+    instructions=INSTRUCTIONS,
+
+    tools=[search_laws, search_law],
 )
 
-# --- Jednorazový beh so streamom (ak chceš test bez chatu) ---
-async def run_once(session_id: str, name: str, prompt: str):
-    print(f"[Session: {session_id}] [User: {name}] -> {prompt}")
-    # Reset per-run embedding usage counters
-    usage_counters["embedding_tokens"] = 0
-    usage_counters["embedding_model"] = "text-embedding-3-small"
-    save_message(session_id, "user", prompt)
-    # Načítaj posledných 5 správ ako pamäť konverzácie
-    mem_rows = fetch_memory(session_id, limit=10)
-    if mem_rows:
-        memory_block = "\n".join([f"{r['role']}: {r['content']}" for r in mem_rows])
-        enriched_input = f"[MEMORY]\n{memory_block}\n[/MEMORY]\n\n[USER QUESTION]\n{prompt}"
-    else:
-        enriched_input = prompt
-    result = Runner.run_streamed(esmeralda, input=enriched_input)
-    buf = []
-    usage = None
-    async for ev in result.stream_events():
-        # Streamujeme len textové delty a zachytíme completed event s usage
-        from openai.types.responses import ResponseTextDeltaEvent, ResponseCompletedEvent
-        if ev.type == "raw_response_event" and isinstance(ev.data, ResponseTextDeltaEvent):
-            piece = ev.data.delta or ""
-            buf.append(piece)
-            print(piece, end="", flush=True)
-        elif ev.type == "response.completed":
-            try:
-                usage = ev.data.response.output[0].usage
-            except Exception as e:
-                print(f"[Token Usage] Parse error: {e}")
-    print()  # newline
-    assistant_text = "".join(buf)
-    if assistant_text.strip():
-        save_message(session_id, "assistant", assistant_text)
-
-    # Najprv skús usage z run contextu (Agents SDK ukladá usage tam po dokončení streamu)
-    if not usage:
-        try:
-            ctx = getattr(result, "context_wrapper", None)
-            if ctx and getattr(ctx, "usage", None):
-                usage = ctx.usage
-        except Exception as e:
-            print(f"[Token Usage] Context usage parse error: {e}")
+# --- Dávkovaný zápis streamu na stdout (menej write/flush syscallov) ---
+STREAM_FLUSH_BYTES = 8192
+STREAM_FLUSH_INTERVAL = 0.025  # s
+STREAM_FLUSH_DELTAS = 64
 
-    # Fallback – ak by context nemal usage, skús finálnu odpoveď
-    if not usage:
-        try:
-            final = await result.get_final_response()
-            if final and getattr(final, "output", None):
-                out0 = final.output[0]
-                if hasattr(out0, "usage") and out0.usage:
-                    usage = out0.usage
-        except Exception as e:
-            print(f"[Token Usage] Final response parse error: {e}")
+def _stdout_raw_fd() -> int | None:
+    """Fd skutočného stdout, ak nie je TTY (pipe/súbor) – tam píšeme bajty priamo cez os.write."""
+    try:
+        if sys.__stdout__ is not None and not sys.__stdout__.isatty():
+            return sys.__stdout__.fileno()
+    except (AttributeError, OSError, ValueError):
+        pass
+    return None
+
+_STDOUT_FD = _stdout_raw_fd()
+
+def _write_stdout(data: bytes) -> None:
+    """
+    Zapíše UTF-8 bajty na stdout a vyprázdni ho. Pipe/súbor dostane jeden os.write bez TextIOWrapper,
+    TTY ide cez sys.stdout.buffer a presmerovaný stdout (napr. redirect_stdout) cez jeho write().
+    """
+    stream = sys.stdout
+    buffer = getattr(stream, "buffer", None)
+    if stream is not sys.__stdout__ or buffer is None:
+        stream.write(data.decode("utf-8"))
+        stream.flush()
+        return
+    # Najprv to, čo je ešte v bufferi po print(), aby sa nepomiešalo poradie
+    stream.flush()
+    encoding = (stream.encoding or "utf-8").lower().replace("-", "")
+    if encoding != "utf8":
+        data = data.decode("utf-8").encode(stream.encoding, "replace")
+    if _STDOUT_FD is None:
+        buffer.write(data)
+        buffer.flush()
+        return
+    view = memoryview(data)
+    while view:
+        view = view[os.write(_STDOUT_FD, view):]
+
+class _StreamBatcher:
+    """Zhromažďuje UTF-8 delty a zapisuje ich na stdout po dávkach (podľa veľkosti alebo času); prvú hneď."""
+    def __init__(self, max_bytes: int = STREAM_FLUSH_BYTES, interval: float = STREAM_FLUSH_INTERVAL):
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.pending = bytearray()
+        self.pending_deltas = 0
+        self.last_flush = time.monotonic()
+        self.first_sent = False
+        self._timer: asyncio.TimerHandle | None = None
+    def write(self, piece: bytes) -> None:
+        self.pending += piece
+        self.pending_deltas += 1
+        # Prvú deltu nikdy nedávkujeme (TTFT); ďalej podľa veľkosti/počtu/času
+        if not self.first_sent:
+            self.first_sent = bool(piece)
+            self.flush()
+        elif (
+            len(self.pending) >= self.max_bytes
+            or self.pending_deltas >= STREAM_FLUSH_DELTAS
+            or time.monotonic() - self.last_flush >= self.interval
+        ):
+            self.flush()
+        elif self._timer is None and self.pending:
+            # Časovač dopíše dávku aj keď ďalšia delta nepríde (napr. počas tool callu)
+            self._timer = asyncio.get_running_loop().call_later(self.interval, self.flush)
+    def flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.pending:
+            _write_stdout(bytes(self.pending))
+            self.pending.clear()
+        self.pending_deltas = 0
+        self.last_flush = time.monotonic()
 
-    # Uloženie usage (LLM + embeddingy). Aj keď LLM usage chýba, zaúčtujeme aspoň embeddingy.
+# --- Skladanie vstupu s pamäťou konverzácie ---
+_MEMORY_HEADER = "[MEMORY]\n"
+_MEMORY_FOOTER = "\n[/MEMORY]\n\n[USER QUESTION]\n"
+
+# --- Jednorazový beh so streamom (ak chceš test bez chatu) ---
+async def run_once(session_id: str, name: str, prompt: str, on_delta: Callable[[str], None] | None = None):
+    """
+    Jeden ťah agenta. Bez on_delta sa odpoveď streamuje na stdout (CLI);
+    s on_delta (app.py) ide každá textová delta priamo volajúcemu a stdout sa nepoužíva.
+    """
+    if on_delta is None:
+        # Hlavička len pre CLI – na serveri by otázky používateľov (citlivé) končili v logoch
+        print(f"[Session: {session_id}] [User: {name}] -> {prompt}")
+    agent = esmeralda
+    # Per-run embedding usage counters (viditeľné pre tools cez contextvar)
+    counters = {"embedding_tokens": 0, "embedding_model": EMBED_MODEL}
+    counters_token = usage_counters.set(counters)
+    # LLM usage; ostane 0/0, ak beh zlyhá skôr, než ho SDK spočíta
     in_tok = 0
     out_tok = 0
-    if usage:
+    try:
+        # Načítaj pamäť konverzácie pred týmto ťahom (teplá session ide z procesu, studená zo Supabase;
+        # Supabase klient je synchrónny – select púšťame mimo event loopu)
+        mem_rows = await asyncio.to_thread(fetch_memory, session_id, MEMORY_LIMIT)
+        # Zápis ide cez frontu writera (neblokuje) a zároveň do pamäte v procese
+        save_message(session_id, "user", prompt)
+        # Pamäť končí aktuálnou otázkou
+        mem_rows = (mem_rows + [_memory_row("user", prompt)])[-MEMORY_LIMIT:]
+        if mem_rows:
+            memory_block = "\n".join(
+                r.get("line") or _memory_row(r["role"], r["content"])["line"] for r in mem_rows
+            )
+            enriched_input = "".join((_MEMORY_HEADER, memory_block, _MEMORY_FOOTER, prompt))
+        else:
+            enriched_input = prompt
+        started = time.monotonic()
+        result = Runner.run_streamed(agent, input=enriched_input)
+        buf = bytearray()  # celá odpoveď ako UTF-8; dekóduje sa raz na konci
+        out = _StreamBatcher() if on_delta is None else None
+        first_sent = False
+        async for ev in result.stream_events():
+            # Dispatch podľa typu eventu (string) – bez isinstance na pydantic triedach
+            if ev.type != "raw_response_event":
+                continue
+            t = getattr(ev.data, "type", None)
+            if t == "response.output_text.delta":
+                piece = ev.data.delta or ""
+                if not piece:
+                    continue
+                if not first_sent:
+                    first_sent = True
+                    print(f"[TTFT] {session_id}: {(time.monotonic() - started) * 1000:.0f} ms", file=_stderr)
+                data = piece.encode("utf-8")
+                buf += data
+                if out is None:
+                    on_delta(piece)
+                else:
+                    out.write(data)
+        if out is not None:
+            out.flush()
+            print()  # newline
+        assistant_text = buf.decode("utf-8")
+        if assistant_text.strip():
+            save_message(session_id, "assistant", assistant_text)
+
+        # Usage z run contextu – Agents SDK ho po dokončení streamu sčíta cez všetky volania modelu
+        usage = result.context_wrapper.usage
+
+        # Uloženie usage (LLM + embeddingy). Aj keď LLM usage chýba, zaúčtujeme aspoň embeddingy.
+        if usage:
+            try:
+                # Podpora dvoch konvencií názvov: input/output_tokens a prompt/completion_tokens
+                # Bežný prípad (input_tokens existuje) skončí na prvom getattr
+                in_tok = int(getattr(usage, "input_tokens", None) or getattr(usage, "prompt_tokens", 0) or 0)
+                out_tok = int(getattr(usage, "output_tokens", None) or getattr(usage, "completion_tokens", 0) or 0)
+            except Exception as e:
+                print(f"[Token Usage] Could not parse usage fields: {e}", file=_stderr)
+        else:
+            print("[Token Usage] Usage not available; will record embedding usage only if present.", file=_stderr)
+    finally:
+        # Aj pri chybe behu zapíš usage – embeddingy už boli zaplatené – a vráť contextvar
         try:
-            # Podpora dvoch konvencií názvov: input/output_tokens a prompt/completion_tokens
-            in_tok = int(getattr(usage, "input_tokens", getattr(usage, "prompt_tokens", 0)) or 0)
-            out_tok = int(getattr(usage, "output_tokens", getattr(usage, "completion_tokens", 0)) or 0)
+            # Vždy zapíš; ak LLM usage nie je, ostanú 0/0 a uloží sa aspoň embedder
+            save_token_usage(
+                session_id,
+                agent.model,
+                in_tok,
+                out_tok,
+                embedding_model=counters.get("embedding_model"),
+                embedding_input_tokens=int(counters.get("embedding_tokens", 0) or 0),
+            )
         except Exception as e:
-            print(f"[Token Usage] Could not parse usage fields: {e}")
-    else:
-        print("[Token Usage] Usage not available; will record embedding usage only if present.")
-    try:
-        # Vždy zapíš; ak LLM usage nie je, ostanú 0/0 a uloží sa aspoň embedder
-        save_token_usage(
-            session_id,
-            esmeralda.model,
-            in_tok,
-            out_tok,
-            embedding_model=usage_counters.get("embedding_model"),
-            embedding_input_tokens=int(usage_counters.get("embedding_tokens", 0) or 0),
-        )
-    except Exception as e:
-        print(f"[Supabase] Token usage insert error: {e}")
+            print(f"[Supabase] Token usage insert error: {e}", file=_stderr)
+        usage_counters.reset(counters_token)
+    # Zápisy dopíše writer na pozadí – koniec streamu na ne nečaká (CLI ich dopíše cez close_clients)
 
 if __name__ == "__main__":
-    import sys
-    if len(sys.argv) >= 4:
+    # uvloop má rýchlejší event loop; ak nie je nainštalovaný, ostane štandardný asyncio
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    if sys.argv[1:] in (["--provision"], ["--warm-embed-cache"]):
+        async def _admin(step) -> None:
+            try:
+                await step()
+            finally:
+                await close_clients()
+
+        asyncio.run(_admin(provision_collection if sys.argv[1] == "--provision" else warm_embed_cache))
+    elif len(sys.argv) >= 4:
         session_id = sys.argv[1]
         name = sys.argv[2]
         prompt = " ".join(sys.argv[3:])
-        esmeralda.instructions = esmeralda.instructions.format(name=name)
-        asyncio.run(run_once(session_id, name, prompt))
+
+        async def _cli() -> None:
+            try:
+                await run_once(session_id, name, prompt)
+            finally:
+                # CLI končí procesom – dopíš frontu writera a zavri klienty
+                await close_clients()
+
+        asyncio.run(_cli())
     else:
-        print("Použitie: python agent.py <session_id> <name> <prompt>")
+        print("Použitie: python agent.py <session_id> <name> <prompt>\n"
+              "          python agent.py --provision         (payload index, voliteľne kvantizácia kolekcie)\n"
+              "          python agent.py --warm-embed-cache  (predhriatie EMBED_CACHE_DB frázami z EMBED_WARMUP_FILE)")
@@ -1,54 +1,70 @@
 # app.py
 import asyncio
-import re
-import json
-from contextlib import redirect_stdout
+from collections import deque
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
+import orjson
 import uvicorn
 
-from agent import run_once, esmeralda
+from agent import close_clients, run_once, start_writer
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Klienty (OpenAI HTTP/2 pool, Qdrant) vznikajú raz pri importe agent.py a zdieľajú sa medzi requestami
+    # Writer do Supabase beží od štartu – prvý request nečaká na jeho vytvorenie
+    start_writer()
+    yield
+    # Dopíš rozpracované zápisy a zavri spojenia
+    await close_clients()
 
-def _tokenize_small(s: str, size: int = 3):
-    """Yield small token-like chunks of size `size` codepoints from string `s`.
-    Preserves order; does not drop characters. Simple and UTF-8 safe.
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Zlučovanie SSE rámcov: prvú deltu pošli hneď (TTFT), ďalej keď sa nazbiera SSE_COALESCE_CHARS
+# znakov alebo keď je najstaršia čakajúca delta staršia ako SSE_COALESCE_INTERVAL (max. vek, nie len ticho)
+SSE_COALESCE_CHARS = 256
+SSE_COALESCE_INTERVAL = 0.03  # s
+SSE_KEEPALIVE_INTERVAL = 20   # s
+
+def _sse(obj) -> bytes:
+    # orjson vracia UTF-8 bajty (bez \u escapovania), netreba json.dumps + encode
+    return b"data: " + orjson.dumps(obj) + b"\n\n"
+
+_RUN_DONE = object()  # značka konca behu vo fronte
+
+class _SPSC:
     """
-    i = 0
-    n = len(s)
-    while i < n:
-        yield s[i:i+size]
-        i += size
-
-class _QueueWriter:
-    """File-like writer that pushes writes into an asyncio.Queue."""
-    def __init__(self, q: asyncio.Queue[str]):
-        self.q = q
-    def write(self, s: str) -> int:
-        if s:
-            try:
-                self.q.put_nowait(s)
-            except Exception:
-                pass
-        return len(s)
-    def flush(self) -> None:
-        return None
+    Fronta pre jedného producenta (on_delta z run_once) a jedného konzumenta (SSE generátor).
+    deque + jeden asyncio.Event – put nevytvára future ani nebudí čakateľov ako asyncio.Queue.
+    """
+    def __init__(self):
+        self.items: deque = deque()
+        self.ready = asyncio.Event()
+    def put_nowait(self, item) -> None:
+        self.items.append(item)
+        self.ready.set()
+    async def drain(self, timeout: float) -> list:
+        """Vráti všetky čakajúce položky naraz; ak do `timeout` nič nepríde, vyhodí asyncio.TimeoutError."""
+        if not self.items:
+            self.ready.clear()
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        items = list(self.items)
+        self.items.clear()
+        return items
 
 async def sse_chat_stream(session_id: str, name: str, prompt: str):
     """
-    Run agent.run_once(session_id, name, prompt) and stream its stdout as SSE.
+    Run agent.run_once(session_id, name, prompt) and stream its text deltas as SSE.
     All token accounting (LLM + embeddings) is done inside agent.run_once.
     """
-    q: asyncio.Queue[str] = asyncio.Queue()
-
-    first_print_skipped = False  # drop the first session/user log line
+    q = _SPSC()
 
     async def _runner():
-        writer = _QueueWriter(q)
-        with redirect_stdout(writer):
-            await run_once(session_id, name, prompt)
-        await q.put("__RUN_DONE__")
+        try:
+            # Delty idú z run_once priamo do fronty – bez presmerovania stdout
+            await run_once(session_id, name, prompt, on_delta=q.put_nowait)
+        finally:
+            q.put_nowait(_RUN_DONE)
 
     task = asyncio.create_task(_runner())
 
@@ -57,41 +73,51 @@ async def sse_chat_stream(session_id: str, name: str, prompt: str):
 
     # Emit the user prompt once at the beginning
     if prompt:
-        yield ("data: " + json.dumps({"delta": prompt}, ensure_ascii=False) + "\n\n").encode("utf-8")
-
-    buffer = ""
+        yield _sse({"delta": prompt})
+
+    loop = asyncio.get_running_loop()
+    pending: list[str] = []  # delty čakajúce na odoslanie; spájajú sa raz na rámec
+    pending_len = 0          # počet znakov v `pending`
+    pending_since = 0.0      # loop.time() prvej delty v `pending`
+    first_sent = False
+    done = False
     try:
-        while True:
+        while not done:
+            # S čakajúcimi dátami čakáme len do ich max. veku; inak do keep-alive
+            timeout = (
+                max(0.0, pending_since + SSE_COALESCE_INTERVAL - loop.time()) if pending else SSE_KEEPALIVE_INTERVAL
+            )
             try:
-                chunk = await asyncio.wait_for(q.get(), timeout=20)
+                # Všetko, čo sa nazbieralo od poslednej iterácie – jedno prebudenie na dávku
+                items = await q.drain(timeout)
             except asyncio.TimeoutError:
-                # keep-alive comment for proxies during idle
-                yield b": keepalive\n\n"
+                if pending:
+                    yield _sse({"delta": "".join(pending)})
+                    pending.clear()
+                    pending_len = 0
+                else:
+                    # keep-alive comment for proxies during idle
+                    yield b": keepalive\n\n"
                 continue
 
-            if chunk == "__RUN_DONE__":
-                if buffer:
-                    # If the last buffered text is the session/user line, drop it.
-                    if not first_print_skipped and re.match(r"^\s*\[Session:.*\]\s*\[User:.*\]\s*->", buffer):
-                        first_print_skipped = True
-                    else:
-                        for tok in _tokenize_small(buffer):
-                            yield ("data: " + json.dumps({"delta": tok}, ensure_ascii=False) + "\n\n").encode("utf-8")
-                    buffer = ""
-                break
-
-            buffer += chunk
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n", 1)
-                if not line:
-                    continue
-                # Drop the first log line that looks like: [Session: ...] [User: ...] -> ...
-                if not first_print_skipped and re.match(r"^\s*\[Session:.*\]\s*\[User:.*\]\s*->", line):
-                    first_print_skipped = True
-                    continue
-                # Emit in small token-like chunks (3 codepoints)
-                for tok in _tokenize_small(line):
-                    yield ("data: " + json.dumps({"delta": tok}, ensure_ascii=False) + "\n\n").encode("utf-8")
+            for chunk in items:
+                if chunk is _RUN_DONE:
+                    done = True
+                    break
+                if not pending:
+                    pending_since = loop.time()
+                pending.append(chunk)
+                pending_len += len(chunk)
+            if pending and (
+                done
+                or not first_sent
+                or pending_len >= SSE_COALESCE_CHARS
+                or loop.time() - pending_since >= SSE_COALESCE_INTERVAL
+            ):
+                yield _sse({"delta": "".join(pending)})
+                pending.clear()
+                pending_len = 0
+                first_sent = True
 
     finally:
         try:
@@ -113,16 +139,16 @@ async def chat(request: Request):
     }
     """
     try:
-        data = await request.json()
+        data = orjson.loads(await request.body())
     except Exception:
-        return JSONResponse({"error": "Invalid JSON body"}, status_code=400)
+        return ORJSONResponse({"error": "Invalid JSON body"}, status_code=400)
 
     session_id = data.get("session_id")
     name = data.get("name", "User")
     prompt = data.get("prompt")
 
     if not session_id or not prompt:
-        return JSONResponse({"error": "session_id a prompt sú povinné"}, status_code=400)
+        return ORJSONResponse({"error": "session_id a prompt sú povinné"}, status_code=400)
 
     return StreamingResponse(
         sse_chat_stream(session_id, name, prompt),
@@ -136,4 +162,5 @@ def health():
 
 # Lokálne spustenie (v produkcii beží cez gunicorn/uvicorn worker)
 if __name__ == "__main__":
-    uvicorn.run("app:app", host="0.0.0.0", port=8000)
\ No newline at end of file
+    # uvloop + httptools (uvicorn[standard]) – rýchlejší event loop a HTTP parser pre SSE
+    uvicorn.run("app:app", host="0.0.0.0", port=8000, loop="uvloop", http="httptools")
\ No newline at end of file